@@ -3,5 +3,6 @@ __version__ = "0.1.1"
 from .utils import round_controlled
 from .cluster import FlusterCluster
 from .exceptions import ClusterEmptyError
+from .penalty_box import SharedPenaltyBox
 
-__all__ = ["FlusterCluster", "ClusterEmptyError"]
+__all__ = ["FlusterCluster", "ClusterEmptyError", "SharedPenaltyBox"]
@@ -1,17 +1,70 @@
 from collections import defaultdict
 from itertools import cycle
 import functools
+import inspect
 import logging
+import math
+import random
+import threading
+import time
 
 import mmh3
 import redis
-from redis.exceptions import ConnectionError, TimeoutError
+from redis.exceptions import ConnectionError, LockError, TimeoutError
 
 from .exceptions import ClusterEmptyError
 from .penalty_box import PenaltyBox
 
 log = logging.getLogger(__name__)
 
+# Client methods which don't talk to redis themselves, so aren't tracked.
+# Generator functions, like scan_iter, aren't either.
+_UNTRACKED = frozenset(
+    (
+        "bf",
+        "cf",
+        "client",
+        "close",
+        "cms",
+        "from_pool",
+        "from_url",
+        "ft",
+        "get_cache",
+        "get_connection_kwargs",
+        "get_encoder",
+        "get_retry",
+        "json",
+        "lock",
+        "monitor",
+        "pipeline",
+        "pubsub",
+        "register_script",
+        "set_response_callback",
+        "set_retry",
+        "tdigest",
+        "topk",
+        "ts",
+        "vset",
+    )
+)
+# Blocking commands count as in flight, but say nothing about latency
+_BLOCKING = frozenset(
+    (
+        "blmove",
+        "blmpop",
+        "blpop",
+        "brpop",
+        "brpoplpush",
+        "bzmpop",
+        "bzpopmax",
+        "bzpopmin",
+        "wait",
+        "waitaof",
+        "xread",
+        "xreadgroup",
+    )
+)
+
 
 class FlusterCluster(object):
     """A pool of redis instances where dead nodes are automatically removed.
@@ -25,12 +78,28 @@ class FlusterCluster(object):
     isn't a huge problem (provided expiries are respected).
 
     The FlusterCluster instance can be iterated through, and only active
-    connections will be returned.
+    connections will be returned. By default iteration is strict round-robin;
+    see `ITERATION_MODES` for load-aware alternatives.
     """
 
+    #: How __next__ picks a client. The load-aware modes score each client
+    #: by (in-flight calls + 1) * average latency.
+    #:
+    #: - round_robin: strict rotation
+    #: - least_outstanding: fewest in-flight calls, rotating between ties
+    #: - weighted: random, weighted by the inverse of the score
+    #: - p2c: lower score of two random clients ("power of two choices")
+    #:
+    #: Calls are only tracked while a load-aware mode is on.
+    ITERATION_MODES = ("round_robin", "least_outstanding", "weighted", "p2c")
+
+    #: Share of weighted and p2c picks made uniformly at random, so clients
+    #: with a bad score are still used, and their score updated, now and then.
+    EXPLORATION = 0.05
+
     @classmethod
-    def from_settings(cls, conn_settingses):
-        return cls(redis.Redis(**c) for c in conn_settingses)
+    def from_settings(cls, conn_settingses, **kwargs):
+        return cls([redis.Redis(**c) for c in conn_settingses], **kwargs)
 
     def __init__(
         self,
@@ -38,16 +107,33 @@ class FlusterCluster(object):
         penalty_box_min_wait=10,
         penalty_box_max_wait=300,
         penalty_box_wait_multiplier=1.5,
+        penalty_box=None,
+        iteration_mode="round_robin",
     ):
-        self.penalty_box = PenaltyBox(
-            min_wait=penalty_box_min_wait,
-            max_wait=penalty_box_max_wait,
-            multiplier=penalty_box_wait_multiplier,
-        )
+        """
+        :param penalty_box: Optional penalty box to use instead of a private
+            one, e.g. a `SharedPenaltyBox` so node health is shared between
+            worker processes. The `penalty_box_*` settings are then ignored.
+        :param iteration_mode: One of `ITERATION_MODES`
+        """
+        if iteration_mode not in self.ITERATION_MODES:
+            raise ValueError("Unknown iteration mode %r." % (iteration_mode,))
+        self.iteration_mode = iteration_mode
+        self._client_stats = {}  # pool_id -> _ClientStats
+        self._rotation = 0  # tie breaker for least_outstanding
+        if penalty_box is None:
+            penalty_box = PenaltyBox(
+                min_wait=penalty_box_min_wait,
+                max_wait=penalty_box_max_wait,
+                multiplier=penalty_box_wait_multiplier,
+            )
+        self.penalty_box = penalty_box
         self.active_clients = self._prep_clients(clients)
         self.initial_clients = {c.pool_id: c for c in clients}
         self.clients = cycle(self.initial_clients.values())
         self._sort_clients()
+        self._flights = {}  # key -> _Flight, loads in progress in this process
+        self._flights_lock = threading.Lock()
 
     def __iter__(self):
         """Updates active clients each time it's iterated through."""
@@ -56,12 +142,22 @@ class FlusterCluster(object):
 
     def __next__(self):
         """Always returns a client, or raises an Exception if none are available."""
+        # refresh connections if they're back up
+        self._prune_penalty_box()
+
         # raise Exception if no clients are available
         if len(self.active_clients) == 0:
             raise ClusterEmptyError("All clients are down.")
 
-        # refresh connections if they're back up
-        self._prune_penalty_box()
+        if self.iteration_mode == "least_outstanding":
+            return self._least_outstanding()
+        elif self.iteration_mode in ("weighted", "p2c"):
+            if random.random() < self.EXPLORATION:
+                return random.choice(self.active_clients)
+        if self.iteration_mode == "weighted":
+            return self._weighted()
+        elif self.iteration_mode == "p2c":
+            return self._power_of_two_choices()
 
         # return the first client that's active
         for client in self.clients:
@@ -72,6 +168,55 @@ class FlusterCluster(object):
         """Python 2/3 compatibility."""
         return self.__next__()
 
+    @property
+    def round_members(self):
+        """Clients each round of iteration must visit, for `round_controlled`.
+
+        None in round_robin mode, where a round ends when the first client
+        comes back around. Other modes don't visit clients in order, so
+        `round_controlled` needs to know who is left.
+        """
+        if self.iteration_mode == "round_robin":
+            return None
+        return list(self.active_clients)
+
+    def _scores(self):
+        """Score active clients by (in-flight calls + 1) * average latency.
+
+        Clients without any calls yet get the mean latency of the others.
+        """
+        stats = [self._client_stats[c.pool_id] for c in self.active_clients]
+        known = [s.latency for s in stats if s.latency is not None]
+        default = sum(known) / len(known) if known else 1.0
+        return [
+            (s.in_flight + 1) * (default if s.latency is None else s.latency)
+            for s in stats
+        ]
+
+    def _least_outstanding(self):
+        self._rotation = (self._rotation + 1) % len(self.active_clients)
+        rotated = (
+            self.active_clients[self._rotation :]
+            + self.active_clients[: self._rotation]
+        )
+        return min(rotated, key=lambda c: self._client_stats[c.pool_id].in_flight)
+
+    def _weighted(self):
+        weights = [1.0 / max(score, 1e-6) for score in self._scores()]
+        point = random.uniform(0, sum(weights))
+        for client, weight in zip(self.active_clients, weights):
+            point -= weight
+            if point <= 0:
+                return client
+        return self.active_clients[-1]
+
+    def _power_of_two_choices(self):
+        if len(self.active_clients) == 1:
+            return self.active_clients[0]
+        scores = self._scores()
+        a, b = random.sample(range(len(self.active_clients)), 2)
+        return self.active_clients[a if scores[a] <= scores[b] else b]
+
     def _sort_clients(self):
         """Make sure clients are sorted consistently for consistent results."""
         self.active_clients.sort(key=lambda c: c.pool_id)
@@ -89,6 +234,7 @@ class FlusterCluster(object):
             if hasattr(client, "pool_id"):
                 raise ValueError("%r is already part of a pool.", client)
             setattr(client, "pool_id", pool_id)
+            self._client_stats[pool_id] = _ClientStats()
             # Wrap all public functions
             self._wrap_functions(client)
         return clients
@@ -97,19 +243,32 @@ class FlusterCluster(object):
         """Wrap public functions to catch ConnectionError.
 
         When an error happens, it puts the client in the penalty box
-        so that it won't be retried again for a little while.
+        so that it won't be retried again for a little while. Calls are
+        also tracked for the load-aware iteration modes.
         """
+        stats = self._client_stats[client.pool_id]
 
-        def wrap(fn):
+        def wrap(fn, tracked, blocking):
             def wrapper(*args, **kwargs):
                 """Simple wrapper for to catch dead clients."""
+                started = None
+                if tracked and self.iteration_mode != "round_robin":
+                    started = stats.start()
+                succeeded = False
                 try:
-                    return fn(*args, **kwargs)
+                    result = fn(*args, **kwargs)
+                    succeeded = True
+                    return result
                 except (ConnectionError, TimeoutError):  # TO THE PENALTY BOX!
                     self._penalize_client(client)
                     raise
+                finally:
+                    if started is not None:
+                        stats.finish(started, sample=succeeded and not blocking)
 
-            return functools.update_wrapper(wrapper, fn)
+            wrapper = functools.update_wrapper(wrapper, fn)
+            wrapper.__wrapped__ = fn  # not set by Python 2
+            return wrapper
 
         for name in dir(client):
             if name.startswith("_"):
@@ -121,7 +280,8 @@ class FlusterCluster(object):
             if not callable(obj):
                 continue
             log.debug("Wrapping %s", name)
-            setattr(client, name, wrap(obj))
+            tracked = name not in _UNTRACKED and not _is_generator_function(obj)
+            setattr(client, name, wrap(obj, tracked, name in _BLOCKING))
 
     def _prune_penalty_box(self):
         """Restores clients that have reconnected.
@@ -136,6 +296,21 @@ class FlusterCluster(object):
         if added:
             self._sort_clients()
 
+        if not self.penalty_box.shared:
+            return
+        # drop clients penalized elsewhere, e.g. by another process
+        down = self.penalty_box.penalized_ids(len(self.initial_clients))
+        if not down:
+            return
+        for client in list(self.active_clients):
+            if client.pool_id in down:
+                try:
+                    self.active_clients.remove(client)
+                except ValueError:
+                    continue  # another thread got here first
+                log.warning("%r marked down by another process.", client)
+                self.penalty_box.add(client)
+
     def get_client(self, shard_key):
         """Get the client for a given shard, based on what's available.
 
@@ -195,3 +370,242 @@ class FlusterCluster(object):
                 element__score[element] = max(element__score[element], int(count))
 
         return element__score
+
+    def get_or_compute(
+        self,
+        key,
+        loader,
+        ttl,
+        beta=1.0,
+        lock=False,
+        lock_timeout=10,
+        wait_timeout=None,
+        serializer=None,
+        deserializer=None,
+    ):
+        """Get a cached value, calling `loader` to compute it on a miss.
+
+        Concurrent misses for the same key in this process are coalesced, so
+        `loader` runs once and every caller gets its result. Shortly before
+        the key expires, a caller may refresh it early, with a probability
+        that grows as expiry nears and as `loader` gets slower; meanwhile
+        other callers keep getting the cached value, and if the early refresh
+        fails it is logged and the cached value returned.
+
+        Values come back as the client returns them (usually bytes) whether
+        they were cached or just computed, unless a `deserializer` is given.
+        The time `loader` took is stored next to the value in `<key>:delta`,
+        and the lock, if used, is `<key>:lock`.
+
+        :param key: Cache key, also used as the shard key
+        :param loader: Callable taking no arguments which returns the value.
+            None can't be cached, so it raises a ValueError.
+        :param ttl: Expiry of the cached value, in seconds
+        :param beta: Eagerness of early refresh. 0 disables it.
+        :param lock: Also take a redis lock on the routed node so that only
+            one process on any host computes the value
+        :param lock_timeout: Expiry of the lock, and how long to wait for
+            another process to compute the value before doing it ourselves
+        :param wait_timeout: How long to wait for another thread to compute
+            the value before doing it ourselves. None waits for as long as
+            it takes.
+        :param serializer: Callable turning the result of `loader` into
+            something redis can store, e.g. `json.dumps`
+        :param deserializer: Callable applied to every value returned,
+            e.g. `json.loads`
+        """
+        if deserializer is None:
+            deserializer = _identity
+        client = self.get_client(key)
+        value, remaining, delta = self._get_cached(client, key)
+        if value is not None and not self._refresh_early(remaining, delta, beta):
+            return deserializer(value)
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if value is not None:  # being refreshed, serve what we have
+                return deserializer(value)
+            if flight.wait(wait_timeout):
+                return deserializer(flight.result())
+            log.warning("Got no result from another thread for %r.", key)
+            return deserializer(
+                self._compute(client, key, loader, ttl, lock, lock_timeout, serializer)
+            )
+
+        try:
+            result = self._compute(
+                client, key, loader, ttl, lock, lock_timeout, serializer
+            )
+        except Exception as e:
+            flight.fail(e)
+            if value is None:
+                raise
+            log.exception("Early refresh of %r failed, serving cached value.", key)
+            return deserializer(value)
+        else:
+            flight.finish(result)
+        finally:
+            # Wakes waiters even on KeyboardInterrupt and the like, in which
+            # case they compute the value themselves
+            flight.abandon()
+            with self._flights_lock:
+                del self._flights[key]
+        return deserializer(result)
+
+    @staticmethod
+    def _suffixed(key, suffix):
+        if isinstance(key, bytes):
+            return key + suffix.encode("utf-8")
+        return key + suffix
+
+    def _execute(self, client, pipe):
+        """Execute a pipeline, penalizing the client if it's down."""
+        started = None
+        if self.iteration_mode != "round_robin":
+            stats = self._client_stats[client.pool_id]
+            started = stats.start()
+        succeeded = False
+        try:
+            result = pipe.execute()
+            succeeded = True
+            return result
+        except (ConnectionError, TimeoutError):
+            self._penalize_client(client)
+            raise
+        finally:
+            if started is not None:
+                stats.finish(started, sample=succeeded)
+
+    def _get_cached(self, client, key):
+        """:returns: (value, seconds until expiry, seconds taken to compute)"""
+        pipe = client.pipeline(transaction=False)
+        pipe.get(key).pttl(key).get(self._suffixed(key, ":delta"))
+        value, pttl, delta = self._execute(client, pipe)
+        return value, pttl / 1000.0, float(delta or 0)
+
+    @staticmethod
+    def _refresh_early(remaining, delta, beta):
+        """Decide whether to recompute a value before it expires.
+
+        See "Optimal Probabilistic Cache Stampede Prevention", Vattani et al.
+        """
+        if remaining <= 0 or not delta or beta <= 0:
+            return False
+        return -delta * beta * math.log(1.0 - random.random()) >= remaining
+
+    def _compute(self, client, key, loader, ttl, lock, lock_timeout, serializer):
+        """Run `loader` and cache its result on `client`.
+
+        :returns: the result as the client would return it when cached
+        """
+        redis_lock = None
+        if lock:
+            redis_lock = client.lock(self._suffixed(key, ":lock"), timeout=lock_timeout)
+            if not redis_lock.acquire(blocking=False):
+                # Another process is computing it, give it a chance to finish
+                redis_lock = None
+                deadline = time.time() + lock_timeout
+                while time.time() < deadline:
+                    value = client.get(key)
+                    if value is not None:
+                        return value
+                    time.sleep(0.05)
+                log.warning("Timed out waiting on another process for %r.", key)
+        try:
+            start = time.time()
+            value = loader()
+            delta = time.time() - start
+            if value is None:
+                raise ValueError("Loader for %r returned None." % (key,))
+            if serializer is not None:
+                value = serializer(value)
+            encoder = client.connection_pool.get_encoder()
+            value = encoder.decode(encoder.encode(value))
+            pipe = client.pipeline(transaction=False)
+            pipe.set(key, value, ex=ttl).set(
+                self._suffixed(key, ":delta"), delta, ex=ttl
+            )
+            self._execute(client, pipe)
+            return value
+        finally:
+            if redis_lock is not None:
+                try:
+                    redis_lock.release()
+                except LockError:
+                    log.info("Lock for %r expired before it was released.", key)
+
+
+class _ClientStats(object):
+    """In-flight calls and moving average latency of a client."""
+
+    def __init__(self, decay=0.2):
+        self.in_flight = 0
+        self.latency = None  # seconds, None until the first call finishes
+        self._decay = decay
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+        return time.time()
+
+    def finish(self, started, sample=True):
+        """Record the end of a call, and its latency if `sample` is set."""
+        elapsed = time.time() - started
+        with self._lock:
+            self.in_flight -= 1
+            if not sample:
+                return
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += self._decay * (elapsed - self.latency)
+
+
+def _is_generator_function(fn):
+    """Like inspect.isgeneratorfunction, but looks through our wrappers."""
+    while hasattr(fn, "__wrapped__"):
+        fn = fn.__wrapped__
+    return inspect.isgeneratorfunction(fn)
+
+
+def _identity(value):
+    return value
+
+
+class _Flight(object):
+    """A load in progress that other threads can wait on."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._finished = False
+        self._result = None
+        self._exc = None
+
+    def finish(self, result):
+        self._result = result
+        self._finished = True
+        self._done.set()
+
+    def fail(self, exc):
+        self._exc = exc
+        self._finished = True
+        self._done.set()
+
+    def abandon(self):
+        """Wake waiters without a result, if it didn't finish or fail."""
+        self._done.set()
+
+    def wait(self, timeout):
+        """:returns: whether the load finished or failed within `timeout`"""
+        self._done.wait(timeout)
+        return self._finished
+
+    def result(self):
+        if self._exc is not None:
+            raise self._exc
+        return self._result
@@ -1,9 +1,18 @@
+from contextlib import contextmanager
 import heapq
 import logging
+import mmap
+import os
+import struct
+import threading
 import time
 
 from redis.exceptions import ConnectionError, TimeoutError
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 log = logging.getLogger(__name__)
 
@@ -11,6 +20,8 @@ log = logging.getLogger(__name__)
 class PenaltyBox(object):
     """A place for redis clients being put in timeout."""
 
+    shared = False  # whether clients can be penalized by other processes
+
     def __init__(self, min_wait=10, max_wait=300, multiplier=1.5):
         self._clients = []  # heapq of (release_time, (client, last_wait))
         self._client_ids = set()  # client ids in the penalty box
@@ -50,3 +61,169 @@ class PenaltyBox(object):
                     timer,
                     wait,
                 )
+
+
+class SharedPenaltyBox(PenaltyBox):
+    """A penalty box whose state is shared by every process on the host.
+
+    State lives in a memory-mapped file, one slot per ``pool_id``, guarded by
+    an ``flock``. A client penalized by one process is seen as down by all
+    of them, and only one process probes it when its wait expires. Processes
+    must build their clusters from the same settings, in the same order, so
+    that ``pool_id`` refers to the same node everywhere.
+
+    ``flock`` locks belong to an open file, so the file is reopened in each
+    process. A box created before forking workers is safe to use in them.
+    """
+
+    shared = True
+    _slot = struct.Struct("<dd")  # (release_time, last_wait); 0 release == up
+
+    def __init__(self, path, min_wait=10, max_wait=300, multiplier=1.5, slots=256):
+        if fcntl is None:
+            raise NotImplementedError("SharedPenaltyBox needs fcntl, a Unix module.")
+        super(SharedPenaltyBox, self).__init__(
+            min_wait=min_wait, max_wait=max_wait, multiplier=multiplier
+        )
+        self._local = {}  # pool_id -> client, penalized as seen by this process
+        self._path = path
+        self._slots = slots
+        self._pid = None  # process which opened _fd and _map
+        self._fd = None
+        self._map = None
+        self._thread_lock = threading.Lock()  # threads share the flock
+        self._open_lock = threading.Lock()
+        self._slots_struct = None  # reads the first slots in one go
+        self._open()
+
+    def _open(self):
+        """Open the state file for this process, if not done yet."""
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid != os.getpid():
+                self._reopen()
+
+    def _reopen(self):
+        # After a fork the inherited fd shares our parent's lock, so drop it
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+        size = self._slots * self._slot.size
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._thread_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        self._open()
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, client):
+        if not 0 <= client.pool_id < self._slots:
+            raise ValueError(
+                "pool_id %r does not fit in %s slots." % (client.pool_id, self._slots)
+            )
+        return client.pool_id * self._slot.size
+
+    def _read(self, client):
+        self._open()
+        return self._slot.unpack_from(self._map, self._offset(client))
+
+    def _write(self, client, release, wait):
+        self._slot.pack_into(self._map, self._offset(client), release, wait)
+
+    def add(self, client):
+        """Add a client to the penalty box.
+
+        If another process already penalized it, its wait is left alone.
+        """
+        with self._locked():
+            if client.pool_id in self._local:
+                log.info("%r is already in the penalty box. Ignoring.", client)
+                return
+            release, _ = self._read(client)
+            if not release:
+                self._write(client, time.time() + self._min_wait, self._min_wait)
+            self._local[client.pool_id] = client
+
+    def is_penalized(self, client):
+        """Whether any process on the host has the client in the penalty box."""
+        release, _ = self._read(client)
+        return bool(release)
+
+    def penalized_ids(self, count):
+        """Get the pool ids below `count` which any process has penalized."""
+        if count > self._slots:
+            raise ValueError(
+                "%s pool ids do not fit in %s slots." % (count, self._slots)
+            )
+        self._open()
+        size = count * self._slot.size
+        if self._slots_struct is None or self._slots_struct.size != size:
+            self._slots_struct = struct.Struct("<%dd" % (2 * count))
+        releases = self._slots_struct.unpack_from(self._map)[::2]
+        return set(pool_id for pool_id, release in enumerate(releases) if release)
+
+    def get(self):
+        """Get any clients ready to be used.
+
+        Clients restored by another process are returned without a probe.
+
+        :returns: Iterable of redis clients
+        """
+        self._open()
+        with self._thread_lock:
+            penalized = list(self._local.items())
+        for pool_id, client in penalized:
+            # Peek without locking, most of the time it's still waiting
+            release, _ = self._read(client)
+            if release and release >= time.time():
+                continue
+            with self._locked():
+                release, last_wait = self._read(client)
+                if not release:  # restored elsewhere
+                    probe = False
+                    restored = self._local.pop(pool_id, None) is not None
+                elif release < time.time() and pool_id in self._local:
+                    # Hold the slot for the duration of our probe
+                    probe = True
+                    self._write(client, time.time() + last_wait, last_wait)
+                else:
+                    continue  # another thread or process is probing it
+            if not probe:
+                if restored:
+                    yield client
+                continue
+            connect_start = time.time()
+            try:
+                client.echo("test")  # reconnected if this succeeds.
+            except (ConnectionError, TimeoutError):
+                timer = time.time() - connect_start
+                wait = min(int(last_wait * self._multiplier), self._max_wait)
+                with self._locked():
+                    self._write(client, time.time() + wait, wait)
+                log.info(
+                    "%r is still down after a %s second attempt to connect. Retrying in %ss.",
+                    client,
+                    timer,
+                    wait,
+                )
+                continue
+            with self._locked():
+                self._write(client, 0, 0)
+                restored = self._local.pop(pool_id, None) is not None
+            if restored:
+                yield client
@@ -1,5 +1,15 @@
 def round_controlled(cycled_iterable, rounds=1):
-    """Return after <rounds> passes through a cycled iterable."""
+    """Return after <rounds> passes through a cycled iterable.
+
+    If the iterable has `round_members` other than None, as a FlusterCluster
+    not iterating in round_robin mode does, see `_covering_rounds`.
+    Otherwise a round ends when the first item comes back around.
+    """
+    if getattr(cycled_iterable, "round_members", None) is not None:
+        for item in _covering_rounds(cycled_iterable, rounds):
+            yield item
+        return
+
     round_start = None
     rounds_completed = 0
 
@@ -13,3 +23,22 @@ def round_controlled(cycled_iterable, rounds=1):
             return
 
         yield item
+
+
+def _covering_rounds(cycled_iterable, rounds):
+    """Rounds which visit every member at least once, in any order.
+
+    A round takes one item from the iterable per member, then yields any
+    members it didn't get. Members are re-read as we go, since they can
+    change mid-round.
+    """
+    items = iter(cycled_iterable)
+    for _ in range(rounds):
+        seen = []
+        while not seen or len(seen) < len(cycled_iterable.round_members):
+            item = next(items)
+            seen.append(item)
+            yield item
+        for item in cycled_iterable.round_members:
+            if item not in seen:
+                yield item
@@ -1,5 +1,7 @@
 from __future__ import absolute_import, print_function
 
+import json
+import threading
 import time
 import unittest
 import sys
@@ -264,3 +266,197 @@ class FlusterClusterTests(unittest.TestCase):
         self.assertEqual(
             set([new_count, 2]), set(revrange.values())
         )  # max value found for duplicates is returned
+
+    def test_get_or_compute(self):
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.2)
+            return 42
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.cluster.get_or_compute("coalesced", loader, 10, beta=0)
+                )
+            )
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # concurrent misses only load once
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b"42"] * 10)
+
+        # later calls are served from the cache, with the same type
+        cached = self.cluster.get_or_compute("coalesced", loader, 10, beta=0)
+        self.assertEqual(cached, b"42")
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_compute_serializer(self):
+        kwargs = dict(serializer=json.dumps, deserializer=json.loads)
+        computed = self.cluster.get_or_compute(
+            "serialized", lambda: {"a": 1}, 10, **kwargs
+        )
+        cached = self.cluster.get_or_compute(
+            "serialized", lambda: {"a": 2}, 10, **kwargs
+        )
+        self.assertEqual(computed, {"a": 1})
+        self.assertEqual(cached, {"a": 1})
+
+    def test_get_or_compute_failure(self):
+        def loader():
+            raise ValueError("oops")
+
+        self.assertRaises(ValueError, self.cluster.get_or_compute, "failed", loader, 10)
+        self.assertEqual(self.cluster.get_or_compute("failed", lambda: 1, 10), b"1")
+
+    def test_get_or_compute_early_refresh_failure(self):
+        # a failed early refresh still serves the cached value
+        key = "refresh"
+        client = self.cluster.get_client(key)
+        client.set(key, "old", ex=10)
+        client.set(key + ":delta", 100, ex=10)
+
+        def loader():
+            raise ValueError("oops")
+
+        value = self.cluster.get_or_compute(key, loader, 10, beta=1000000)
+        self.assertEqual(value, b"old")
+
+    def test_get_or_compute_none(self):
+        self.assertRaises(
+            ValueError, self.cluster.get_or_compute, "none", lambda: None, 10
+        )
+
+    def test_get_or_compute_slow_loader(self):
+        # waiters wait for the leader however long it takes, not lock_timeout
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.5)
+            return 1
+
+        threads = [
+            threading.Thread(
+                target=self.cluster.get_or_compute,
+                args=("slow", loader, 10),
+                kwargs=dict(beta=0, lock_timeout=0.1),
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_compute_interrupted(self):
+        # waiters shouldn't hang when the loader raises a BaseException
+        def loader():
+            time.sleep(0.2)
+            raise KeyboardInterrupt()
+
+        def interrupted():
+            try:
+                self.cluster.get_or_compute("interrupted", loader, 10)
+            except KeyboardInterrupt:
+                pass
+
+        leader = threading.Thread(target=interrupted)
+        leader.start()
+        time.sleep(0.1)
+        value = self.cluster.get_or_compute("interrupted", lambda: 1, 10)
+        leader.join()
+        self.assertEqual(value, b"1")
+
+    def test_get_or_compute_lock(self):
+        key = "locked"
+        client = self.cluster.get_client(key)
+        client.set(key + ":lock", "other process")
+
+        # waits for the other process, then gives up and loads it
+        value = self.cluster.get_or_compute(
+            key, lambda: "mine", 10, lock=True, lock_timeout=0.2
+        )
+        self.assertEqual(value, b"mine")
+
+        # uses what the other process stored
+        client.delete(key)
+        timer = threading.Timer(0.1, lambda: client.set(key, "theirs"))
+        timer.start()
+        value = self.cluster.get_or_compute(
+            key, lambda: "mine", 10, lock=True, lock_timeout=5
+        )
+        timer.join()
+        self.assertEqual(value, b"theirs")
+
+    def test_iteration_modes(self):
+        self.assertRaises(
+            ValueError, FlusterCluster, [], iteration_mode="fastest_first"
+        )
+        for instance in self.instances:
+            delattr(instance.conn, "pool_id")
+        for mode in FlusterCluster.ITERATION_MODES:
+            cluster = FlusterCluster(
+                [i.conn for i in self.instances], iteration_mode=mode
+            )
+            returned_clients = set()
+            for idx, client in enumerate(cluster):
+                client.incr("key", 1)
+                returned_clients.add(client)
+                if idx >= 30:
+                    break
+            self.assertEqual(len(returned_clients), 3)
+            for instance in self.instances:
+                delattr(instance.conn, "pool_id")
+
+    def test_least_outstanding(self):
+        self.cluster.iteration_mode = "least_outstanding"
+        busy = self.cluster.active_clients[0]
+        self.cluster._client_stats[busy.pool_id].in_flight = 5
+        for idx, client in enumerate(self.cluster):
+            self.assertNotEqual(client, busy)
+            if idx >= 10:
+                break
+
+    def test_load_aware_visits_every_client(self):
+        # a client with a bad score is still picked now and then
+        for mode in ("weighted", "p2c"):
+            self.cluster.iteration_mode = mode
+            slow = self.cluster.active_clients[0]
+            for client in self.cluster.active_clients:
+                self.cluster._client_stats[client.pool_id].latency = 0.001
+            self.cluster._client_stats[slow.pool_id].latency = 1.0
+            picks = [next(self.cluster) for _ in range(1000)]
+            self.assertIn(slow, picks)
+
+    def test_call_tracking(self):
+        client = self.cluster.active_clients[0]
+        stats = self.cluster._client_stats[client.pool_id]
+
+        # nothing is tracked in round_robin mode
+        client.incr("key", 1)
+        client.set("text", "not a number")
+        self.assertIsNone(stats.latency)
+
+        self.cluster.iteration_mode = "p2c"
+        client.pipeline()
+        client.scan_iter()
+        self.assertIsNone(stats.latency)
+        # only calls which succeed are sampled
+        self.assertRaises(redis.ResponseError, client.incr, "text", 1)
+        self.assertIsNone(stats.latency)
+        self.assertEqual(stats.in_flight, 0)
+        client.blpop("empty", timeout=1)
+        self.assertIsNone(stats.latency)
+        self.assertEqual(stats.in_flight, 0)
+        client.incr("key", 1)
+        self.assertIsNotNone(stats.latency)
+        self.assertLess(stats.latency, 0.5)
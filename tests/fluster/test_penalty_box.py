@@ -1,10 +1,14 @@
+import os
+import shutil
+import tempfile
+import threading
 import time
 import unittest
 
 import mock
 from redis.exceptions import ConnectionError
 
-from fluster.penalty_box import PenaltyBox
+from fluster.penalty_box import PenaltyBox, SharedPenaltyBox
 
 
 class PenaltyBoxTests(unittest.TestCase):
@@ -47,5 +51,107 @@ class PenaltyBoxTests(unittest.TestCase):
         self.assertEqual(list(self.box.get()), [client])
 
 
+class SharedPenaltyBoxTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "fluster.state")
+        self.box = SharedPenaltyBox(self.path, min_wait=0.5, max_wait=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _client(self, failures=0):
+        client = mock.MagicMock()
+        client.pool_id = 0
+        client.echo.side_effect = [ConnectionError()] * failures + [None]
+        return client
+
+    def test_penalty_box_backoff(self):
+        """Basic test that the shared penalty box backs off."""
+        client = self._client(failures=1)
+        self.box.add(client)
+        self.assertEqual(list(self.box.get()), [])
+        time.sleep(1)
+        self.assertEqual(list(self.box.get()), [])
+        self.assertTrue(self.box.is_penalized(client))
+        time.sleep(1)
+        self.assertEqual(list(self.box.get()), [client])
+        self.assertFalse(self.box.is_penalized(client))
+
+    def test_penalty_shared(self):
+        """A client penalized in one box is penalized in the others."""
+        other = SharedPenaltyBox(self.path, min_wait=0.5, max_wait=2)
+        client, other_client = self._client(), self._client()
+        self.assertFalse(other.is_penalized(other_client))
+        self.box.add(client)
+        self.assertTrue(other.is_penalized(other_client))
+
+    def test_probe_shared(self):
+        """Only one box probes, and the others see the recovery."""
+        other = SharedPenaltyBox(self.path, min_wait=0.5, max_wait=2)
+        client, other_client = self._client(), self._client()
+        self.box.add(client)
+        other.add(other_client)
+        time.sleep(1)
+        self.assertEqual(list(self.box.get()), [client])
+        self.assertEqual(list(other.get()), [other_client])
+        self.assertEqual(client.echo.call_count, 1)
+        self.assertEqual(other_client.echo.call_count, 0)
+        self.assertFalse(other.is_penalized(other_client))
+
+    def test_penalized_ids(self):
+        self.box.add(self._client())
+        self.assertEqual(self.box.penalized_ids(2), set([0]))
+
+    def test_threaded_get(self):
+        """Threads pruning together return a recovered client once."""
+        box = SharedPenaltyBox(self.path, min_wait=0.1, max_wait=2)
+        other = SharedPenaltyBox(self.path, min_wait=0.1, max_wait=2)
+        for _ in range(20):
+            client, other_client = self._client(), self._client()
+            box.add(client)
+            other.add(other_client)
+            time.sleep(0.2)
+            self.assertEqual(list(other.get()), [other_client])
+
+            results, errors = [], []
+
+            def prune():
+                try:
+                    results.extend(box.get())
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=prune) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(results, [client])
+
+    def test_lock_after_fork(self):
+        """Processes forked from one box don't hold the lock together."""
+        log_path = os.path.join(self.tmpdir, "log")
+        pids = []
+        for _ in range(2):
+            pid = os.fork()
+            if pid == 0:  # child
+                try:
+                    with self.box._locked():
+                        with open(log_path, "a") as log:
+                            log.write("in\n")
+                        time.sleep(0.3)
+                        with open(log_path, "a") as log:
+                            log.write("out\n")
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        with open(log_path) as log:
+            self.assertEqual(log.read().split(), ["in", "out", "in", "out"])
+
+
 if __name__ == "__main__":
     unittest.main()
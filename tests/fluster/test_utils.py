@@ -57,3 +57,16 @@ class FlusterClusterTests(unittest.TestCase):
 
         # should raise stopiteration at appropriate time
         assert idx == (desired_rounds * len(self.cluster.active_clients) - 1)
+
+        # load-aware iteration still visits every client each round
+        self.cluster.iteration_mode = "p2c"
+        slow = self.cluster.active_clients[0]
+        for client in self.cluster.active_clients:
+            self.cluster._client_stats[client.pool_id].latency = 0.001
+        self.cluster._client_stats[slow.pool_id].latency = 1.0
+        conns = list(round_controlled(self.cluster, rounds=desired_rounds))
+
+        num_clients = len(self.cluster.active_clients)
+        assert len(conns) <= desired_rounds * (2 * num_clients - 1)
+        for client in self.cluster.active_clients:
+            assert conns.count(client) >= desired_rounds